@@ -15,6 +15,18 @@
 # 4. [Составление портрета пользователя каждого региона](#portrait)
 # 5. [Проверка гипотез](#check_hypo)
 # 6. [Общий вывод](#common_out)
+# 7. [Компактное представление каталога](#compact)
+# 8. [Объединение изданий одной игры на разных платформах](#titles)
+# 9. [Проверка качества данных](#validation)
+# 10. [Кэширование промежуточных результатов](#cache)
+# 11. [Чувствительность выводов к параметрам анализа](#sweep)
+# 12. [Доли рынка по регионам](#market_share)
+# 13. [Инкрементальная загрузка новых выгрузок](#ingest)
+# 14. [Связь оценок и продаж](#score_sales)
+# 15. [Генерация отчёта](#report)
+# 16. [Статистики с учётом заполненных пропусков](#robust_stats)
+# 17. [Сочетания жанров и платформ](#affinity)
+# 18. [Общий файл данных для параллельных процессов](#columnar)
 
 # <a id='step_1'></a>
 # 
@@ -940,3 +952,1634 @@ else:
 # 
 # 
 # Вообщем желательно чтобы игра была с хорошим рейтигом, была из перечня жанров: Shooter , Sports, Platform, Role-Playing, Fighting. Также нужно смотреть на потенциальный рынок игры ведь можно выпустить для Японии и иметь хорошие продажи а во всё остальном мире проажи будут не очень. Ну и хорошо бы чтобы сама игры была хорошая обьективно) Это все параметры которые мне удалось вроде выявить для успеха. 
+
+# <a id='compact'></a>
+# # Шаг 7: Компактное представление каталога
+
+# После очистки в `df` остаются строки Python в `name`, кириллические строки в `type_by_sum_sales` на каждую строку, заглушка `'Unknown'` в `rating` и float64 во всех колонках с оценками и продажами. Соберём компактное представление каталога: строки кодируем словарём (категории), продажи и оценки храним во float32, год в int16, а вместо строк-заглушек держим битовые маски пропусков (NA bitmaps). Маски для оценок и года восстанавливаем по исходному файлу, так как в `df` пропуски уже заполнены медианами.
+
+# In[ ]:
+
+
+sales_columns = ['na_sales', 'eu_sales', 'jp_sales', 'other_sales', 'sum_sales']
+score_columns = ['critic_score', 'user_score']
+
+def compact_catalogue(data):
+    catalogue = pd.DataFrame(index=data.index)
+    for column in ['name', 'platform', 'genre', 'type_by_sum_sales']:
+        catalogue[column] = data[column].astype('category')
+    catalogue['rating'] = data['rating'].replace('Unknown', np.nan).astype('category')
+    catalogue['year_of_release'] = data['year_of_release'].astype('int16')
+    for column in sales_columns + score_columns:
+        catalogue[column] = data[column].astype('float32')
+    return catalogue
+
+def catalogue_na_masks(data, path='./games.csv'):
+    raw = pd.read_csv(path).loc[data.index]
+    user_score = pd.to_numeric(raw['User_Score'], errors='coerce').fillna(0)
+    return {
+        'year_of_release': raw['Year_of_Release'].isna().to_numpy(),
+        'critic_score': raw['Critic_Score'].isna().to_numpy(),
+        'user_score': (user_score == 0).to_numpy(),
+        'rating': (data['rating'] == 'Unknown').to_numpy(),
+    }
+
+def pack_na_masks(masks):
+    return {column: np.packbits(mask) for column, mask in masks.items()}
+
+def unpack_na_mask(bitmaps, column, size):
+    return np.unpackbits(bitmaps[column], count=size).astype(bool)
+
+
+# In[ ]:
+
+
+catalogue = compact_catalogue(df)
+na_bitmaps = pack_na_masks(catalogue_na_masks(df))
+
+
+# Сравним занимаемую память исходного `df` и компактного каталога вместе с битовыми масками
+
+# In[ ]:
+
+
+df_memory = df.memory_usage(deep=True).sum()
+catalogue_memory = catalogue.memory_usage(deep=True).sum() + sum(bitmap.nbytes for bitmap in na_bitmaps.values())
+print('df:', round(df_memory / 2**20, 2), 'MB, каталог:', round(catalogue_memory / 2**20, 2),
+      'MB, сжатие в', round(df_memory / catalogue_memory, 1), 'раз')
+
+
+# Проверим что результаты анализа не изменились. Для этого посчитаем основные результаты (продажи платформ по годам, топ-5 по регионам, продажи по жанрам и p-value обоих тестов) на `df` и на каталоге и сравним их между собой. Для каталога пропуски в `rating` на время сравнения снова подписываем как `'Unknown'`.
+
+# In[ ]:
+
+
+def rating_labels(data):
+    if isinstance(data['rating'].dtype, pd.CategoricalDtype):
+        return data['rating'].cat.add_categories('Unknown').fillna('Unknown')
+    return data['rating']
+
+def analysis_summary(data, years=range(2012, 2017)):
+    data = data.assign(rating=rating_labels(data))
+    period = data[(data['year_of_release'].isin(years)) & (data['platform'].isin(year_of_platform_release.index))]
+    summary = {
+        'platform_by_year': data.pivot_table(
+            index='year_of_release', columns='platform', values='sum_sales', aggfunc='sum', observed=True).stack().sort_index(),
+        'genre_sum_sales': period.groupby('genre', observed=True)['sum_sales'].agg(['sum', 'mean', 'median']).sort_index().stack(),
+    }
+    for column in ['platform', 'genre', 'rating']:
+        for region in ['na_sales', 'eu_sales', 'jp_sales']:
+            summary[column + '_' + region] = period.groupby(column, observed=True)[region].sum().sort_values(
+                ascending=False).head()
+    for column, first, second in [('platform', 'XOne', 'PC'), ('genre', 'Action', 'Sports')]:
+        summary[first + '_' + second] = pd.Series([st.ttest_ind(
+            period[period[column] == first]['user_score'].astype('float64'),
+            period[period[column] == second]['user_score'].astype('float64')
+        ).pvalue])
+    return summary
+
+
+# In[ ]:
+
+
+reference_summary = analysis_summary(df)
+catalogue_summary = analysis_summary(catalogue)
+for key in reference_summary:
+    assert list(reference_summary[key].index) == list(catalogue_summary[key].index), key
+    assert np.allclose(reference_summary[key], catalogue_summary[key], rtol=1e-4), key
+print('Результаты анализа на каталоге совпадают с результатами на df')
+
+
+# **Вывод**
+# 
+# Компактный каталог занимает в несколько раз меньше памяти чем `df`: больше всего экономят категории вместо строк в `name`, `type_by_sum_sales` и `rating`, а также float32 и int16 вместо 64-битных чисел. Пропуски теперь хранятся битовыми масками (1 бит на строку), а не строками `'Unknown'` и `'tbd'`. При этом все основные результаты анализа совпадают с посчитанными на `df` (с точностью до погрешности float32).
+
+# <a id='titles'></a>
+# # Шаг 8: Объединение изданий одной игры на разных платформах
+
+# Одна и та же игра встречается в `games.csv` один раз на каждую платформу, а `sum_sales` считается построчно, т.е понятия суммарных продаж игры по всем платформам у нас нет. Сравнивать имена попарно на большом каталоге — квадратичная сложность, поэтому строим хэш-индекс: `pd.factorize` раскладывает имена по хэш-таблице за линейное время, нормализуем (нижний регистр, без пунктуации и лишних пробелов) только уникальные имена, а затем ещё раз факторизуем нормализованные имена и получаем `title_id` для каждой строки. Точные дубликаты (одно и то же имя без нормализации, платформа и год) ищем тем же хэшированием через `duplicated` по кодам исходных имён, а `title_id` используем только для группировки изданий. Строки без имени в шаге 2 удалены, поэтому пропуск в `name` здесь считаем ошибкой.
+
+# In[ ]:
+
+
+def normalize_names(names):
+    return (names.astype(str).str.lower()
+            .str.replace(r'[^\w\s]', ' ', regex=True)
+            .str.replace(r'\s+', ' ', regex=True)
+            .str.strip())
+
+def resolve_titles(data):
+    if data['name'].isna().any():
+        raise ValueError('Пропуски в name: ' + str(data['name'].isna().sum()) + ' строк')
+    name_codes, names = pd.factorize(data['name'])
+    title_codes, title_keys = pd.factorize(normalize_names(pd.Series(names)))
+    title_id = title_codes[name_codes]
+    is_duplicate = pd.DataFrame({
+        'name': name_codes,
+        'platform': np.asarray(data['platform']),
+        'year_of_release': np.asarray(data['year_of_release']),
+    }).duplicated().to_numpy()
+    return pd.DataFrame({'title_id': title_id, 'is_duplicate': is_duplicate}, index=data.index)
+
+def title_aggregates(data, resolved):
+    releases = data[sales_columns + ['platform', 'year_of_release']].join(resolved['title_id'])
+    grouped = releases.groupby('title_id', sort=False)
+    titles = grouped[sales_columns].sum()
+    titles['platforms'] = grouped['platform'].nunique()
+    titles['first_year'] = grouped['year_of_release'].min()
+    titles['name'] = data['name'].groupby(resolved['title_id'], sort=False).first()
+    return titles
+
+
+# In[ ]:
+
+
+resolved = resolve_titles(df)
+spelling = resolve_titles(pd.DataFrame(
+    {'name': ['Tetris', 'TETRIS!', 'Tetris'], 'platform': ['GB'] * 3, 'year_of_release': [1989] * 3}))
+assert spelling['title_id'].nunique() == 1 and list(spelling['is_duplicate']) == [False, False, True]
+titles = title_aggregates(df, resolved)
+df_titles = df.join(resolved).join(
+    titles[['sum_sales', 'platforms']].rename(
+        columns={'sum_sales': 'title_sum_sales', 'platforms': 'title_platforms'}),
+    on='title_id')
+
+
+# Посмотрим сколько в данных точных дубликатов и сколько игр выходило сразу на нескольких платформах
+
+# In[ ]:
+
+
+print('Точных дубликатов:', resolved['is_duplicate'].sum())
+print('Уникальных игр:', len(titles), 'из них мультиплатформенных:', (titles['platforms'] > 1).sum())
+
+
+# In[ ]:
+
+
+df_titles[resolved['is_duplicate']]
+
+
+# In[ ]:
+
+
+titles.sort_values(by='sum_sales', ascending=False).head(10)
+
+
+# Дубликаты не удаляем, а только помечаем в колонке `is_duplicate`: в исходных данных такие строки обычно содержат разные продажи (данные за одну игру разбиты на несколько записей), поэтому в суммарные продажи игры они входят.
+# 
+# Проверим что время работы растёт линейно с размером каталога: размножим `df` в 10 и 50 раз и посчитаем время на одну строку.
+
+# In[ ]:
+
+
+import time
+
+for factor in [1, 10, 50]:
+    scaled = pd.concat([df] * factor, ignore_index=True)
+    start = time.perf_counter()
+    title_aggregates(scaled, resolve_titles(scaled))
+    elapsed = time.perf_counter() - start
+    print(len(scaled), 'строк:', round(elapsed, 2), 'c,', round(elapsed / len(scaled) * 1e6, 2), 'мкс на строку')
+
+
+# **Вывод**
+# 
+# Теперь у каждой строки есть `title_id`, общий для всех изданий игры на разных платформах, а в `df_titles` добавлены суммарные продажи игры по всем платформам (`title_sum_sales`) и число платформ (`title_platforms`). Время на одну строку почти не меняется при росте каталога, т.е объединение работает за линейное время и подойдёт и для десятков миллионов строк.
+
+# <a id='validation'></a>
+# # Шаг 9: Проверка качества данных
+
+# В шаге 1 и 2 качество данных я смотрел вручную (`df.info()`, `df.isna().any()`, срезы по `'tbd'`, `value_counts()`), а исправления применялись молча. Соберём проверку в одно место: правила задаются декларативно списком словарей (название правила, векторная проверка, возвращающая маску нарушений, и допустимая доля нарушений), каждое правило — это один векторный проход по своей колонке (строковые колонки один раз переводятся в категории и проверяются только по уникальным значениям, а оба года срока жизни платформы берутся одним поиском по уникальным платформам), на выходе получаем отчёт, который можно сохранить в json, а при `fail=True` запуск падает, если какое-то правило превысило порог.
+# 
+# Для проверки года выхода игры нужны сроки жизни платформ: год выхода платформы и год, после которого игры на неё уже не выпускались (для платформ, на которые игры выходили и в 2016 году, это 2016). Их я взял из википедии. Игра не может выйти раньше своей платформы и позже конца её срока жизни.
+# 
+# Для `rating` в сырых данных допустимы только настоящие коды ESRB (включая устаревший K-A), а заглушка `'Unknown'` из шага 2 разрешается отдельным набором правил только для очищенного `df`.
+
+# In[ ]:
+
+
+last_year = 2016
+platform_lifespans = {
+    '2600': (1977, 1992), 'NES': (1983, 1995), 'TG16': (1987, 1995), 'GEN': (1988, 1997), 'GB': (1989, 2003),
+    'SNES': (1990, 2000), 'NG': (1990, 2004), 'GG': (1990, 1997), 'SCD': (1991, 1996), '3DO': (1993, 1996),
+    'SAT': (1994, 2000), 'PS': (1994, 2006), 'PCFX': (1994, 1998), 'N64': (1996, 2002), 'DC': (1998, 2008),
+    'WS': (1999, 2003), 'PS2': (2000, 2013), 'GBA': (2001, 2008), 'GC': (2001, 2007), 'XB': (2001, 2008),
+    'DS': (2004, 2014), 'PSP': (2004, 2015), 'X360': (2005, last_year), 'PS3': (2006, last_year),
+    'Wii': (2006, last_year), '3DS': (2011, last_year), 'PSV': (2011, last_year), 'WiiU': (2012, last_year),
+    'PS4': (2013, last_year), 'XOne': (2013, last_year), 'PC': (1981, last_year),
+}
+esrb_ratings = ['E', 'T', 'M', 'E10+', 'EC', 'AO', 'RP', 'K-A']
+
+lifespan_table = pd.DataFrame.from_dict(platform_lifespans, orient='index', columns=['first', 'end'], dtype='float64')
+
+def per_unique(values, check, fill=False):
+    values = values.astype('category')
+    result = np.asarray(check(pd.Series(np.asarray(values.cat.categories))))
+    return np.concatenate([result, np.full((1,) + result.shape[1:], fill)])[values.cat.codes.to_numpy()]
+
+def outside_platform_lifespan(data):
+    bounds = per_unique(data['platform'], lambda platform: lifespan_table.reindex(platform).to_numpy(), np.nan)
+    year = np.asarray(data['year_of_release'], dtype='float64')
+    return (year < bounds[:, 0]) | (year > bounds[:, 1])
+
+def rating_rule(allowed):
+    return {'rule': 'rating_unknown_code',
+            'check': lambda data: per_unique(data['rating'], lambda rating: ~rating.isin(allowed)), 'max_share': 0}
+
+validation_rules = [
+    {'rule': 'name_missing', 'check': lambda data: data['name'].isna(), 'max_share': 0.001},
+    {'rule': 'year_missing', 'check': lambda data: data['year_of_release'].isna(), 'max_share': 0.05},
+    {'rule': 'year_outside_platform_lifespan', 'check': outside_platform_lifespan, 'max_share': 0.001},
+    {'rule': 'platform_unknown',
+     'check': lambda data: per_unique(data['platform'], lambda platform: ~platform.isin(platform_lifespans)),
+     'max_share': 0},
+    {'rule': 'critic_score_out_of_range',
+     'check': lambda data: data['critic_score'].notna() & ~data['critic_score'].between(0, 100), 'max_share': 0},
+    {'rule': 'user_score_out_of_range',
+     'check': lambda data: per_unique(data['user_score'], lambda score: pd.to_numeric(score, errors='coerce').pipe(
+         lambda score: score.notna() & ~score.between(0, 10))), 'max_share': 0},
+    {'rule': 'user_score_tbd',
+     'check': lambda data: per_unique(data['user_score'], lambda score: score.astype(str) == 'tbd'),
+     'max_share': 0.2},
+    rating_rule(esrb_ratings),
+] + [
+    {'rule': column + '_negative', 'check': lambda data, column=column: data[column] < 0, 'max_share': 0}
+    for column in ['na_sales', 'eu_sales', 'jp_sales', 'other_sales']
+]
+
+cleaned_validation_rules = [
+    rating_rule(esrb_ratings + ['Unknown']) if rule['rule'] == 'rating_unknown_code' else rule
+    for rule in validation_rules
+]
+
+def validate(data, rules=validation_rules, fail=False):
+    data = {
+        column: values.astype('category')
+        if column in ['platform', 'user_score', 'rating'] and values.dtype != 'category' else values
+        for column, values in data.items()
+    }
+    violations = np.column_stack([np.asarray(rule['check'](data), dtype=bool) for rule in rules])
+    counts = violations.sum(axis=0)
+    report = pd.DataFrame({
+        'rule': [rule['rule'] for rule in rules],
+        'violations': counts,
+        'share': counts / len(violations),
+        'max_share': [rule['max_share'] for rule in rules],
+    })
+    report['failed'] = report['share'] > report['max_share']
+    if fail and report['failed'].any():
+        raise ValueError('Проверка качества данных не пройдена: ' + ', '.join(report.loc[report['failed'], 'rule']))
+    return report
+
+
+# Проверим сырые данные сразу после загрузки и заодно сравним время проверки со временем загрузки файла. Строковые колонки, которые проверяются правилами, сразу читаем как категории, тогда словарь уникальных значений строится ещё при разборе файла и проверке остаётся только работа с кодами.
+
+# In[ ]:
+
+
+start = time.perf_counter()
+raw_games = pd.read_csv('./games.csv', dtype={'Platform': 'category', 'User_Score': 'category', 'Rating': 'category'})
+raw_games.columns = raw_games.columns.str.lower()
+load_time = time.perf_counter() - start
+
+start = time.perf_counter()
+raw_report = validate(raw_games, fail=True)
+validation_time = time.perf_counter() - start
+print('Загрузка:', round(load_time, 3), 'c, проверка:', round(validation_time, 3), 'c,',
+      'проверка / загрузка:', round(validation_time / load_time, 2))
+raw_report
+
+
+# In[ ]:
+
+
+raw_games[outside_platform_lifespan(raw_games)]
+
+
+# Отчёт в машиночитаемом виде
+
+# In[ ]:
+
+
+print(raw_report.to_json(orient='records', force_ascii=False))
+
+
+# Проверим также очищенные данные `df`: после шага 2 пропусков в `name` и `year_of_release`, а также значений `'tbd'` быть не должно. Для `rating` здесь разрешена заглушка `'Unknown'`.
+
+# In[ ]:
+
+
+validate(df, rules=cleaned_validation_rules, fail=True)
+
+
+# **Вывод**
+# 
+# Теперь все проверки качества данных собраны в одном списке правил и считаются векторно, а отчёт можно сохранить в json. В сырых данных нарушаются только ожидаемые правила: пропуски в `name` и `year_of_release`, значения `'tbd'` в `user_score` и единичные игры с годом выхода вне срока жизни своей платформы, все они в пределах порогов. Проверка не бесплатна: на файле такого размера она занимает заметную долю от времени загрузки (отношение выведено выше), большая часть этого времени — постоянные накладные расходы pandas на каждое правило, а не работа со строками, поэтому с ростом файла доля проверки уменьшается.
+
+# <a id='cache'></a>
+# # Шаг 10: Кэширование промежуточных результатов
+
+# Многие выражения в шагах 3-5 считают одно и то же по несколько раз: `new_df.loc[2016].dropna().sort_values(ascending=False)` вычисляется трижды, `year_of_platform_release.index` используется в нескольких срезах, а группировки по `actual_df` повторяются для разных регионов. Сделаем слой кэширования: результат операции хранится по ключу (операция, параметры), а входные данные (таблица и актуальный период) задаются через `set_input`. Зависимости отслеживаются автоматически: если во время вычисления операции она обращается к входу или к другой операции, то запоминается ребро зависимости. Поэтому при изменении входа (например, актуального периода) из кэша удаляются только те результаты, которые от него зависят. Счётчики попаданий и промахов по каждой операции выводятся в отчёт `report()`.
+
+# In[ ]:
+
+
+import inspect
+from collections import defaultdict
+
+def same_value(first, second):
+    if first is second:
+        return True
+    try:
+        return bool(first == second)
+    except (TypeError, ValueError):
+        return False
+
+class PipelineCache:
+    def __init__(self):
+        self.inputs = {}
+        self.operations = {}
+        self.results = {}
+        self.dependents = defaultdict(set)
+        self.stack = []
+        self.stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'invalidated': 0})
+
+    def set_input(self, name, value):
+        if name in self.inputs and same_value(self.inputs[name], value):
+            return
+        self.inputs[name] = value
+        self.invalidate(('input', name))
+
+    def input(self, name):
+        self.track(('input', name))
+        return self.inputs[name]
+
+    def operation(self, func):
+        self.operations[func.__name__] = func
+        return func
+
+    def get(self, operation, *args, **params):
+        bound = inspect.signature(self.operations[operation]).bind(*args, **params)
+        bound.apply_defaults()
+        params = bound.arguments
+        key = (operation, tuple(sorted(params.items())))
+        self.track(key)
+        if key in self.results:
+            self.stats[operation]['hits'] += 1
+            return self.results[key]
+        self.stats[operation]['misses'] += 1
+        self.stack.append(key)
+        try:
+            result = self.operations[operation](**params)
+        finally:
+            self.stack.pop()
+        self.results[key] = result
+        return result
+
+    def track(self, key):
+        if self.stack:
+            self.dependents[key].add(self.stack[-1])
+
+    def invalidate(self, key):
+        for dependent in self.dependents.pop(key, set()):
+            if dependent in self.results:
+                del self.results[dependent]
+                self.stats[dependent[0]]['invalidated'] += 1
+            self.invalidate(dependent)
+
+    def report(self):
+        return pd.DataFrame.from_dict(self.stats, orient='index').rename_axis('operation')
+
+
+# Опишем через кэш операции из шагов 3-5: сводную таблицу продаж платформ по годам (`new_df`), список платформ с продажами в заданном году, годы выхода этих платформ (`year_of_platform_release`), срез актуального периода (`actual_df`) и топ по регионам.
+
+# In[ ]:
+
+
+pipeline = PipelineCache()
+
+@pipeline.operation
+def platform_year_sales():
+    return pipeline.input('games').pivot_table(
+        index='year_of_release', columns='platform', values='sum_sales', aggfunc='sum')
+
+@pipeline.operation
+def platforms_of_year(year):
+    return pipeline.get('platform_year_sales').loc[year].dropna().sort_values(ascending=False)
+
+@pipeline.operation
+def platform_release_years(year):
+    return pipeline.input('games').sort_values(by='year_of_release').pivot_table(
+        index='platform', values='year_of_release', aggfunc='first').loc[
+        pipeline.get('platforms_of_year', year=year).index]
+
+@pipeline.operation
+def actual_games():
+    games = pipeline.input('games')
+    platforms = pipeline.get('platform_release_years', year=pipeline.input('last_year')).index
+    return games[(games['year_of_release'].isin(pipeline.input('actual_years'))) & (games['platform'].isin(platforms))]
+
+@pipeline.operation
+def actual_top(column, region, n=5):
+    return pipeline.get('actual_games').groupby(column)[region].sum().sort_values(ascending=False).head(n)
+
+@pipeline.operation
+def year_top(column, region, year, n=5):
+    games = pipeline.input('games')
+    return games[games['year_of_release'] == year].groupby(column)[region].sum().sort_values(
+        ascending=False).head(n)
+
+
+# Посчитаем все 18 топов из шага 4 (по платформам, жанрам и рейтингам для трёх регионов за актуальный период и за 2016 год) и проверим что результаты совпадают с посчитанными без кэша
+
+# In[ ]:
+
+
+pipeline.set_input('games', df)
+pipeline.set_input('actual_years', range(2012, 2017))
+pipeline.set_input('last_year', 2016)
+
+def regional_tops():
+    return {
+        (column, region, period): (
+            pipeline.get('actual_top', column=column, region=region) if period == 'actual'
+            else pipeline.get('year_top', column=column, region=region, year=2016))
+        for column in ['platform', 'genre', 'rating']
+        for region in ['na_sales', 'eu_sales', 'jp_sales']
+        for period in ['actual', 2016]
+    }
+
+tops = regional_tops()
+assert pipeline.get('actual_games').equals(actual_df)
+assert pipeline.get('actual_top', 'genre', 'na_sales') is pipeline.get('actual_top', column='genre', region='na_sales', n=5)
+assert tops[('platform', 'eu_sales', 'actual')].equals(
+    actual_df.groupby('platform')['eu_sales'].sum().sort_values(ascending=False).head())
+assert pipeline.get('platforms_of_year', year=2016).equals(new_df.loc[2016].dropna().sort_values(ascending=False))
+pipeline.report()
+
+
+# Повторный запрос тех же топов берётся целиком из кэша
+
+# In[ ]:
+
+
+tops = regional_tops()
+pipeline.report()
+
+
+# Теперь поменяем актуальный период на 2013-2016. Из кэша удаляются только срез актуального периода и топы по нему, а топы за 2016 год и сводная таблица по годам остаются в кэше.
+
+# In[ ]:
+
+
+pipeline.set_input('actual_years', range(2013, 2017))
+tops = regional_tops()
+pipeline.report()
+
+
+# **Вывод**
+# 
+# Каждая промежуточная таблица теперь считается один раз и переиспользуется всеми операциями, которые от неё зависят. При изменении актуального периода пересчитываются только 9 топов за актуальный период и сам срез, а не весь анализ. Счётчики в `pipeline.report()` показывают сколько раз каждая операция была взята из кэша, посчитана и сброшена.
+
+# <a id='sweep'></a>
+# # Шаг 11: Чувствительность выводов к параметрам анализа
+
+# Ключевые параметры анализа я выбирал сам и зашил в код: актуальный период 2012-2016, пороги категорий продаж 0.17 и 0.47, уровень значимости 0.05 и заполнение оценок медианой по категории продаж. Проверим насколько выводы зависят от этих решений: прогоним анализ по сетке параметров (начало актуального периода от 2005 до 2014 и три способа заполнения пропусков) и посмотрим как меняются топы по регионам и результаты проверки гипотез. Пороги категорий продаж влияют только на заполнение медианой по категории, поэтому перебираются только для него. Уровень значимости не меняет сам тест, поэтому в пуле считаются только p-значения, а решение об отвержении H0 для каждого уровня значимости принимается уже по готовой таблице.
+# 
+# Конфигурации считаются в пуле процессов. Общие данные готовим один раз в основном процессе: берём очищенный `df`, возвращаем пропуски в оценки по битовым маскам из шага 7 и берём список актуальных платформ из кэша шага 10. Процессы создаются через `fork`, поэтому эти данные и кэши не копируются в каждую задачу. Внутри процесса заполнение оценок кэшируется по (порогам, способу заполнения), а срез периода и топы по регионам — по началу периода, т.е для соседних конфигураций они не пересчитываются.
+# 
+# Ускорение от пула есть только там, где доступен `fork`. На Windows его нет вовсе, а на macOS `fork` после импорта matplotlib небезопасен, поэтому там `fork_map` считает те же задачи по очереди в основном процессе: результат тот же, просто медленнее.
+
+# In[ ]:
+
+
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import product
+
+workers = multiprocessing.cpu_count()
+
+def fork_map(func, tasks):
+    if sys.platform == 'darwin' or 'fork' not in multiprocessing.get_all_start_methods():
+        return list(map(func, tasks))
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        return list(executor.map(func, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+
+sweep_base = df[['platform', 'genre', 'year_of_release', 'na_sales', 'eu_sales', 'jp_sales', 'sum_sales']].assign(
+    critic_score=df['critic_score'].mask(unpack_na_mask(na_bitmaps, 'critic_score', len(df))),
+    user_score=df['user_score'].mask(unpack_na_mask(na_bitmaps, 'user_score', len(df))),
+    actual_platform=df['platform'].isin(pipeline.get('platform_release_years', year=2016).index),
+)
+
+@lru_cache(maxsize=None)
+def sweep_scores(thresholds, imputation):
+    scores = sweep_base[['critic_score', 'user_score']]
+    if imputation == 'tier_median':
+        tiers = np.searchsorted(thresholds, sweep_base['sum_sales'].to_numpy())
+        return scores.fillna(scores.groupby(tiers).transform('median'))
+    if imputation == 'global_median':
+        return scores.fillna(scores.median())
+    return scores
+
+@lru_cache(maxsize=None)
+def sweep_window(window_start, n=3):
+    rows = np.flatnonzero(
+        sweep_base['year_of_release'].between(window_start, 2016) & sweep_base['actual_platform'])
+    period = sweep_base.iloc[rows]
+    tops = {
+        column + '_' + region: ', '.join(
+            period.groupby(column)[region].sum().sort_values(ascending=False).head(n).index)
+        for column in ['platform', 'genre']
+        for region in ['na_sales', 'eu_sales', 'jp_sales']
+    }
+    return rows, period, tops
+
+sweep_pairs = [('platform', 'XOne', 'PC'), ('genre', 'Action', 'Sports')]
+
+def run_sweep_config(config):
+    window_start, thresholds, imputation = config
+    rows, period, tops = sweep_window(window_start)
+    user_score = sweep_scores(thresholds, imputation)['user_score'].iloc[rows]
+    result = {'window_start': window_start, 'thresholds': thresholds, 'imputation': imputation}
+    result.update(tops)
+    for column, first, second in sweep_pairs:
+        pvalue = st.ttest_ind(
+            user_score[period[column] == first], user_score[period[column] == second], nan_policy='omit'
+        ).pvalue
+        result[first + '_' + second + '_pvalue'] = float(pvalue)
+    return result
+
+sweep_imputations = [('tier_median', thresholds) for thresholds in [(0.17, 0.47), (0.1, 0.3), (0.25, 0.75), (0.5, 1.0)]]
+sweep_imputations += [('global_median', None), ('observed', None)]
+sweep_configs = [
+    (window_start, thresholds, imputation)
+    for window_start, (imputation, thresholds) in product(range(2005, 2015), sweep_imputations)
+]
+sweep_alphas = [0.01, 0.05, 0.1]
+
+
+# In[ ]:
+
+
+start = time.perf_counter()
+sweep = pd.DataFrame(fork_map(run_sweep_config, sweep_configs))
+print(len(sweep), 'конфигураций за', round(time.perf_counter() - start, 1), 'c')
+sweep = sweep.merge(pd.DataFrame({'alpha': sweep_alphas}), how='cross')
+for column, first, second in sweep_pairs:
+    sweep[first + '_' + second + '_rejected'] = sweep[first + '_' + second + '_pvalue'] < sweep['alpha']
+
+
+# Проверим что базовая конфигурация воспроизводит результаты обеих гипотез из шага 5. Переменная `results` к этому моменту перезаписана второй гипотезой, поэтому тест для XOne и PC пересчитаем заново.
+
+# In[ ]:
+
+
+baseline = sweep[(sweep['window_start'] == 2012) & (sweep['thresholds'] == (0.17, 0.47))
+                 & (sweep['imputation'] == 'tier_median') & (sweep['alpha'] == 0.05)]
+xone_pc = st.ttest_ind(
+    actual_df[actual_df['platform'] == 'XOne']['user_score'],
+    actual_df[actual_df['platform'] == 'PC']['user_score']
+)
+assert np.isclose(baseline['XOne_PC_pvalue'].iloc[0], xone_pc.pvalue)
+assert np.isclose(baseline['Action_Sports_pvalue'].iloc[0], np.ravel(results.pvalue)[0])
+baseline.T
+
+
+# Как меняются топ-3 платформ и жанров по регионам в зависимости от начала актуального периода
+
+# In[ ]:
+
+
+sweep.drop_duplicates('window_start').set_index('window_start')[
+    [column + '_' + region for column in ['platform', 'genre'] for region in ['na_sales', 'eu_sales', 'jp_sales']]]
+
+
+# Доля конфигураций, в которых отвергается H0, в разбивке по началу периода и способу заполнения пропусков (по всем порогам и уровням значимости)
+
+# In[ ]:
+
+
+sweep.pivot_table(
+    index='window_start', columns='imputation', values=['XOne_PC_rejected', 'Action_Sports_rejected'], aggfunc='mean')
+
+
+# Для заполнения медианой по категории продаж та же доля в разбивке по порогам категорий и уровню значимости (по всем началам периода)
+
+# In[ ]:
+
+
+sweep[sweep['imputation'] == 'tier_median'].pivot_table(
+    index='thresholds', columns='alpha', values=['XOne_PC_rejected', 'Action_Sports_rejected'], aggfunc='mean')
+
+
+# **Вывод**
+# 
+# Все конфигурации считаются за секунды, т.к очищенные данные готовятся один раз, а внутри процессов переиспользуются срезы периодов и заполненные оценки. По таблицам видно, какие выводы устойчивы к выбору параметров (лидеры по регионам, результат гипотез при разных порогах и уровнях значимости), а какие зависят от выбранного актуального периода и способа заполнения пропусков.
+
+# <a id='market_share'></a>
+# # Шаг 12: Доли рынка по регионам
+
+# В шаге 4 портрет пользователя строился 18 отдельными группировками с суммами продаж по топ-5, но без долей и мест относительно всего рынка региона. Посчитаем за один проход по данным плотные массивы NumPy для каждой размерности (платформа, жанр, рейтинг) с осями (регион × значение × год): продажи, доля от продаж региона за год, место в регионе и изменение доли относительно прошлого года. Место считается только для значений с ненулевыми продажами (у остальных пропуск, чтобы отсутствие на рынке не выглядело как последнее место), а значения с одинаковыми продажами делят одно место. Дополнительно храним накопленные по годам суммы, тогда доли и места за любой период получаются разностью двух срезов, без новых группировок.
+
+# In[ ]:
+
+
+share_regions = ['na_sales', 'eu_sales', 'jp_sales', 'other_sales']
+
+def rank_descending(values, axis):
+    greater = (np.expand_dims(values, axis) > np.expand_dims(values, axis + 1)).sum(axis=axis + 1)
+    return np.where(values > 0, greater + 1, np.nan)
+
+def shares_of(sales, axis=1):
+    totals = sales.sum(axis=axis, keepdims=True)
+    return np.divide(sales, totals, out=np.zeros_like(sales), where=totals > 0)
+
+def build_market_shares(data, dimensions=('platform', 'genre', 'rating')):
+    first_year = data['year_of_release'].min()
+    years = np.arange(first_year, data['year_of_release'].max() + 1)
+    year_codes = data['year_of_release'].to_numpy() - first_year
+    sales = data[share_regions].to_numpy(dtype='float64')
+    shares = {'years': years, 'regions': share_regions}
+    for dimension in dimensions:
+        codes, labels = pd.factorize(data[dimension], sort=True)
+        cells = codes * len(years) + year_codes
+        cube = np.stack([
+            np.bincount(cells, weights=sales[:, region], minlength=len(labels) * len(years))
+            for region in range(len(share_regions))
+        ]).reshape(len(share_regions), len(labels), len(years))
+        share = shares_of(cube)
+        shares[dimension] = {
+            'labels': np.asarray(labels),
+            'sales': cube,
+            'cumulative': np.cumsum(cube, axis=2),
+            'share': share,
+            'rank': rank_descending(share, axis=1),
+            'share_delta': np.concatenate(
+                [np.full(share.shape[:2] + (1,), np.nan), np.diff(share, axis=2)], axis=2),
+        }
+    return shares
+
+def period_shares(shares, dimension, first_year, last_year):
+    if first_year > last_year:
+        raise ValueError('Начало периода позже его конца: ' + str(first_year) + ' > ' + str(last_year))
+    years = shares['years']
+    cumulative = shares[dimension]['cumulative']
+    end = np.searchsorted(years, last_year, side='right') - 1
+    start = np.searchsorted(years, first_year) - 1
+    sales = np.zeros(cumulative.shape[:2])
+    if end >= 0:
+        sales = cumulative[:, :, end] - (cumulative[:, :, start] if start >= 0 else 0)
+    share = shares_of(sales, axis=1)
+    return pd.concat({
+        'sales': pd.DataFrame(sales.T, index=shares[dimension]['labels'], columns=share_regions),
+        'share': pd.DataFrame(share.T, index=shares[dimension]['labels'], columns=share_regions),
+        'rank': pd.DataFrame(
+            rank_descending(share, axis=1).T, index=shares[dimension]['labels'], columns=share_regions),
+    }, axis=1).rename_axis(dimension)
+
+
+# In[ ]:
+
+
+market_shares = build_market_shares(df)
+
+
+# Проверим что суммы за период совпадают с группировками из шага 4 (за 2016 год они посчитаны по всем платформам, как и здесь), что места есть ровно у значений с продажами, а для периода вне данных продажи и доли нулевые
+
+# In[ ]:
+
+
+for column in ['platform', 'genre', 'rating']:
+    table = period_shares(market_shares, column, 2016, 2016)
+    for region in ['na_sales', 'eu_sales', 'jp_sales']:
+        expected = df[df['year_of_release'] == 2016].groupby(column)[region].sum().sort_values(ascending=False).head()
+        assert np.allclose(table['sales'][region].loc[expected.index], expected)
+        assert (table['rank'][region].loc[expected.index] == range(1, len(expected) + 1)).all()
+    assert (table['rank'].isna() == (table['sales'] == 0)).all().all()
+    assert (np.isnan(market_shares[column]['rank']) == (market_shares[column]['sales'] == 0)).all()
+for first_year, last_year in [(1900, 1950), (2020, 2030)]:
+    assert (period_shares(market_shares, 'platform', first_year, last_year)[['sales', 'share']] == 0).all().all()
+
+
+# Доли и места платформ по регионам за актуальный период 2012-2016
+
+# In[ ]:
+
+
+period_shares(market_shares, 'platform', 2012, 2016).sort_values(by=('rank', 'na_sales')).head(10)
+
+
+# Изменение доли PS4 и XOne по годам в каждом регионе (в процентных пунктах)
+
+# In[ ]:
+
+
+platform_labels = list(market_shares['platform']['labels'])
+pd.DataFrame({
+    (platform, region): market_shares['platform']['share_delta'][
+        share_regions.index(region), platform_labels.index(platform)] * 100
+    for platform in ['PS4', 'XOne']
+    for region in share_regions
+}, index=market_shares['years']).loc[2013:]
+
+
+# Места жанров по регионам за 2016 год берутся прямо срезом массива мест
+
+# In[ ]:
+
+
+pd.DataFrame(
+    market_shares['genre']['rank'][:, :, list(market_shares['years']).index(2016)].T,
+    index=market_shares['genre']['labels'], columns=share_regions
+).sort_values(by='na_sales')
+
+
+# **Вывод**
+# 
+# Теперь доли рынка и места для всех сочетаний региона, платформы/жанра/рейтинга и года считаются одним проходом через `np.bincount` и хранятся в плотных массивах. Сравнение регионов за любой период — это разность двух срезов накопленных сумм, а за отдельный год — просто срез массива долей или мест. Суммы продаж совпадают с группировками из шага 4.
+
+# <a id='ingest'></a>
+# # Шаг 13: Инкрементальная загрузка новых выгрузок
+
+# Обновлённые выгрузки `games.csv` приходят периодически в той же схеме, а скрипт умеет только обрабатывать весь файл заново. Сделаем загрузку, которая сравнивает новую выгрузку с предыдущей и применяет к сохранённым очищенным данным только изменения.
+# 
+# Разбирать CSV целиком долго, поэтому сначала файл читается просто как строки и каждая строка хэшируется (`pd.util.hash_array`), это хэш содержимого строки. Строки, хэш которых уже был в прошлой выгрузке, не изменились, и их даже не нужно разбирать. Через `pd.read_csv` проходят только новые строки, для них считается ключ по (name, platform, year_of_release). Если ключ новой строки совпадает с ключом пропавшей строки, то это изменённая игра, иначе вставленная, а пропавшие строки без пары считаются удалёнными.
+# 
+# Очистку из шага 2 повторяем векторно для отдельных строк. Медианы для заполнения пропусков (год по платформе, оценки по категории продаж) считаются при первой загрузке и сохраняются вместе с данными, иначе для каждой новой строки пришлось бы пересчитывать их по всему каталогу. Для платформ, которых не было в первой выгрузке, медианы года нет, поэтому пропуск года у них заполняется медианой года по всему каталогу.
+
+# In[ ]:
+
+
+import io
+import os
+import tempfile
+
+def sales_tiers(sum_sales, thresholds=(0.17, 0.47)):
+    return np.select([sum_sales <= thresholds[0], sum_sales <= thresholds[1]], ['Низкий', 'Средний'], 'Высокий')
+
+def numeric_user_scores(user_score):
+    return pd.to_numeric(user_score, errors='coerce').replace(0, np.nan)
+
+def cleaning_medians(raw):
+    games = raw.dropna(subset=['Name'])
+    tiers = sales_tiers(games[['NA_sales', 'EU_sales', 'JP_sales', 'Other_sales']].sum(axis=1))
+    return {
+        'year_of_release': raw.groupby('Platform')['Year_of_Release'].median(),
+        'all_years': raw['Year_of_Release'].median(),
+        'critic_score': games.groupby(tiers)['Critic_Score'].median(),
+        'user_score': numeric_user_scores(games['User_Score']).groupby(tiers).median(),
+    }
+
+def clean_snapshot(raw, medians):
+    games = raw.copy()
+    games.columns = games.columns.str.lower()
+    games['year_of_release'] = games['year_of_release'].fillna(
+        games['platform'].map(medians['year_of_release'])).fillna(medians['all_years']).astype('int64')
+    games = games.dropna(subset=['name'])
+    games['sum_sales'] = games[['na_sales', 'eu_sales', 'jp_sales', 'other_sales']].sum(axis=1)
+    games['type_by_sum_sales'] = sales_tiers(games['sum_sales'])
+    games['critic_score'] = games['critic_score'].fillna(games['type_by_sum_sales'].map(medians['critic_score']))
+    games['user_score'] = numeric_user_scores(games['user_score']).fillna(
+        games['type_by_sum_sales'].map(medians['user_score']))
+    games['rating'] = games['rating'].replace('K-A', 'E').fillna('Unknown')
+    return games
+
+def combine_hashes(hashes):
+    combined = np.zeros(len(hashes[0]), dtype='uint64')
+    for column_hash in hashes:
+        combined = (combined * np.uint64(1000003)) ^ column_hash
+    return combined
+
+def line_ids(lines):
+    hashes = pd.util.hash_array(lines, categorize=False)
+    repeated = pd.Series(hashes).duplicated(keep=False).to_numpy()
+    occurrence = np.zeros(len(hashes), dtype='uint64')
+    occurrence[repeated] = pd.Series(hashes[repeated]).groupby(hashes[repeated]).cumcount().to_numpy()
+    return pd.Index(combine_hashes([hashes, occurrence]), name='row_id')
+
+def release_keys(raw):
+    return combine_hashes([
+        pd.util.hash_pandas_object(raw[column], index=False).to_numpy()
+        for column in ['Name', 'Platform', 'Year_of_Release']
+    ])
+
+snapshot_dtypes = {'Name': str, 'Platform': str, 'Genre': str, 'User_Score': str, 'Rating': str}
+
+def ingest_snapshot(path, state=None):
+    with open(path, encoding='utf-8') as file:
+        header, *lines = file.read().splitlines()
+    lines = np.array(lines, dtype=object)
+    ids = line_ids(lines)
+    if state is None:
+        state = {'keys': pd.Series(np.array([], dtype='uint64'), index=ids[:0]), 'cleaned': None, 'medians': None}
+    positions = state['keys'].index.get_indexer(ids)
+    fresh = positions < 0
+    kept = np.zeros(len(state['keys']), dtype=bool)
+    kept[positions[~fresh]] = True
+    removed = state['keys'][~kept]
+    raw = pd.read_csv(io.StringIO('\n'.join([header, *lines[fresh]])), dtype=snapshot_dtypes).set_axis(ids[fresh])
+    keys = pd.Series(release_keys(raw), index=raw.index)
+    medians = state['medians'] if state['medians'] is not None else cleaning_medians(raw)
+    cleaned = clean_snapshot(raw, medians)
+    if state['cleaned'] is not None:
+        cleaned = pd.concat([state['cleaned'].drop(removed.index, errors='ignore'), cleaned])
+    changed = keys.isin(removed)
+    report = {'inserted': int((~changed).sum()), 'changed': int(changed.sum()),
+              'removed': int((~removed.isin(keys)).sum()), 'rows': len(cleaned)}
+    keys = pd.concat([state['keys'].drop(removed.index), keys])
+    return {'keys': keys, 'cleaned': cleaned, 'medians': medians}, report
+
+def save_state(state, path):
+    pd.to_pickle(state, path)
+
+def load_state(path):
+    return pd.read_pickle(path) if os.path.exists(path) else None
+
+
+# Первая загрузка обрабатывает весь файл целиком. Проверим что результат совпадает с `df` из шага 2
+
+# In[ ]:
+
+
+ingested, ingest_report = ingest_snapshot('./games.csv')
+pd.testing.assert_frame_equal(
+    ingested['cleaned'].sort_values(by=['name', 'platform', 'year_of_release', 'sum_sales']).reset_index(drop=True),
+    df.sort_values(by=['name', 'platform', 'year_of_release', 'sum_sales']).reset_index(drop=True),
+    check_dtype=False)
+ingest_report
+
+
+# Смоделируем следующую выгрузку: у 50 игр обновились продажи в Северной Америке, 20 строк пропали и добавилось 30 новых игр, а также одна игра без года выхода на новой платформе. Остальные строки файла остаются байт в байт такими же, как в прошлой выгрузке.
+
+# In[ ]:
+
+
+with open('./games.csv', encoding='utf-8') as file:
+    header, *snapshot_lines = file.read().splitlines()
+games = pd.read_csv('./games.csv')
+rng = np.random.default_rng(0)
+updated_rows = rng.choice(len(games), 70, replace=False)
+updated = games.loc[updated_rows[:50]].assign(NA_sales=lambda games: games['NA_sales'] + 0.01)
+for row, line in zip(updated_rows[:50], updated.to_csv(header=False, index=False).splitlines()):
+    snapshot_lines[row] = line
+added = games.dropna(subset=['Name']).sample(30, random_state=0).assign(Name=lambda games: games['Name'] + ' 2')
+snapshot_lines = [line for row, line in enumerate(snapshot_lines) if row not in set(updated_rows[50:])]
+snapshot_lines += added.to_csv(header=False, index=False).splitlines()
+snapshot_lines.append('Brand New,NEWP,,Action,0.1,0.05,0,0.01,,,')
+
+snapshot_folder = tempfile.mkdtemp()
+next_snapshot_path = os.path.join(snapshot_folder, 'games.csv')
+with open(next_snapshot_path, 'w', encoding='utf-8') as file:
+    file.write('\n'.join([header] + snapshot_lines) + '\n')
+
+
+# Сравним инкрементальную загрузку с полной обработкой нового файла (чтение и очистка) с теми же медианами
+
+# In[ ]:
+
+
+start = time.perf_counter()
+refreshed, ingest_report = ingest_snapshot(next_snapshot_path, ingested)
+incremental_time = time.perf_counter() - start
+
+start = time.perf_counter()
+full_refresh = clean_snapshot(pd.read_csv(next_snapshot_path, dtype=snapshot_dtypes), ingested['medians'])
+full_time = time.perf_counter() - start
+
+pd.testing.assert_frame_equal(
+    refreshed['cleaned'].sort_values(by=list(full_refresh.columns)).reset_index(drop=True),
+    full_refresh.sort_values(by=list(full_refresh.columns)).reset_index(drop=True))
+assert (refreshed['cleaned'].loc[refreshed['cleaned']['platform'] == 'NEWP', 'year_of_release']
+        == int(ingested['medians']['all_years'])).all()
+print('Инкрементально:', round(incremental_time, 3), 'c, полная обработка:', round(full_time, 3), 'c')
+ingest_report
+
+
+# Чтобы обновлять данные между запусками, состояние (`keys`, `cleaned` и `medians`) сохраняется целиком через `save_state` и читается через `load_state` перед следующей загрузкой (если файла состояния ещё нет, `load_state` возвращает `None` и загрузка будет полной). Сохраним состояние после первой загрузки, прочитаем его как в новом запуске и применим к нему ту же выгрузку
+
+# In[ ]:
+
+
+state_path = os.path.join(snapshot_folder, 'ingest_state.pkl')
+save_state(ingested, state_path)
+reloaded, reloaded_report = ingest_snapshot(next_snapshot_path, load_state(state_path))
+pd.testing.assert_frame_equal(reloaded['cleaned'], refreshed['cleaned'])
+assert reloaded['keys'].equals(refreshed['keys']) and reloaded_report == ingest_report
+save_state(reloaded, state_path)
+reloaded_report
+
+
+# Строки сравниваются по хэшу сырого текста, поэтому изменение форматирования между выгрузками (например `41` вместо `41.0`, другие кавычки или порядок колонок) сделает все строки «изменёнными». Результат при этом останется верным, т.к изменённые строки полностью разбираются заново, но выигрыша от инкрементальной загрузки не будет. Первая загрузка после смены формата фактически будет полной, а следующие снова инкрементальными.
+# 
+# **Вывод**
+# 
+# Первая загрузка даёт ровно тот же `df`, что и шаг 2, а при следующих загрузках разбираются и очищаются только новые и изменённые строки, для остальных файл только читается и хэшируется построчно. Результат совпадает с полной обработкой новой выгрузки с теми же медианами, а отчёт показывает сколько строк вставлено, изменено и удалено.
+
+# <a id='score_sales'></a>
+# # Шаг 14: Связь оценок и продаж
+
+# Пока что связь `critic_score`/`user_score` с `sum_sales` мы смотрели только по диаграмме рассеяния и одной корреляции на платформу. Посчитаем для каждой платформы и каждого жанра условные распределения продаж по корзинам оценок (среднее, медиана и квантили `sum_sales`) одной группировкой сразу по всем группам. Для каждой группы также построим изотоническую регрессию (монотонно неубывающая зависимость продаж от оценки, алгоритм pool adjacent violators), по ней видно с какой оценки продажи перестают расти.
+# 
+# Важный момент: пропуски в оценках в шаге 2 заполнялись медианой по категории продаж, т.е заполненные оценки сами зависят от продаж. Поэтому здесь берём только реально выставленные оценки по битовым маскам из шага 7. Изотоническую регрессию строим не по отдельным играм, а по средним продажам для каждого уникального значения оценки с весом равным числу игр, этих значений не больше сотни. Поэтому подгонка для одной группы занимает доли миллисекунды, и все группы считаются по очереди в основном процессе: запуск пула процессов стоил бы дороже самих вычислений.
+
+# In[ ]:
+
+
+score_bins = {'critic_score': np.arange(0, 101, 10), 'user_score': np.arange(0, 11, 1)}
+score_dimensions = ['platform', 'genre']
+
+def observed_games(score):
+    return df[~unpack_na_mask(na_bitmaps, score, len(df))]
+
+def binned_sales(data, score, dimensions=score_dimensions):
+    buckets = pd.cut(data[score], score_bins[score], include_lowest=True).rename('bucket')
+    return pd.concat({
+        dimension: data.groupby([dimension, buckets], observed=True)['sum_sales'].describe(
+            percentiles=[0.25, 0.5, 0.75, 0.9])
+        for dimension in dimensions
+    }, names=['dimension', 'value', 'bucket'])
+
+def isotonic_fit(values, weights):
+    block_values, block_weights, block_sizes = [], [], []
+    for value, weight in zip(values, weights):
+        block_values.append(value)
+        block_weights.append(weight)
+        block_sizes.append(1)
+        while len(block_values) > 1 and block_values[-2] > block_values[-1]:
+            weight = block_weights[-2] + block_weights[-1]
+            value = (block_values[-2] * block_weights[-2] + block_values[-1] * block_weights[-1]) / weight
+            size = block_sizes[-2] + block_sizes[-1]
+            del block_values[-2:], block_weights[-2:], block_sizes[-2:]
+            block_values.append(value)
+            block_weights.append(weight)
+            block_sizes.append(size)
+    return np.repeat(block_values, block_sizes)
+
+def score_curve_tasks(data, score, dimensions=score_dimensions):
+    tasks = []
+    for dimension in dimensions:
+        curves = data.groupby([dimension, score])['sum_sales'].agg(['mean', 'count'])
+        for value, curve in curves.groupby(level=0):
+            tasks.append((dimension, value, score, curve.index.get_level_values(1).to_numpy(),
+                          curve['mean'].to_numpy(), curve['count'].to_numpy()))
+    return tasks
+
+def fit_score_curve(task):
+    dimension, value, score, scores, means, counts = task
+    fit = isotonic_fit(means, counts)
+    plateau = scores[np.argmax(fit >= fit[0] + 0.9 * (fit[-1] - fit[0]))]
+    return {'dimension': dimension, 'value': value, 'score': score, 'games': counts.sum(),
+            'sales_at_min_score': fit[0], 'sales_at_max_score': fit[-1], 'plateau_score': plateau,
+            'scores': scores, 'fit': fit}
+
+
+# Условные распределения продаж по корзинам оценок критиков для платформы PS4
+
+# In[ ]:
+
+
+critic_binned = binned_sales(observed_games('critic_score'), 'critic_score')
+user_binned = binned_sales(observed_games('user_score'), 'user_score')
+critic_binned.loc[('platform', 'PS4')]
+
+
+# In[ ]:
+
+
+user_binned.loc[('genre', 'Action')]
+
+
+# Подгоняем изотоническую регрессию для всех платформ и жанров по обеим оценкам
+
+# In[ ]:
+
+
+curve_tasks = (score_curve_tasks(observed_games('critic_score'), 'critic_score')
+               + score_curve_tasks(observed_games('user_score'), 'user_score'))
+start = time.perf_counter()
+score_curves = list(map(fit_score_curve, curve_tasks))
+print(len(score_curves), 'групп за', round(time.perf_counter() - start, 2), 'c')
+
+score_plateaus = pd.DataFrame(score_curves).drop(columns=['scores', 'fit']).set_index(
+    ['score', 'dimension', 'value'])
+score_plateaus[score_plateaus['games'] >= 50].sort_values(by='sales_at_max_score', ascending=False)
+
+
+# Оценка, начиная с которой продажи достигают 90% от своего роста, по актуальным платформам
+
+# In[ ]:
+
+
+critic_plateaus = score_plateaus.loc[('critic_score', 'platform')]
+critic_plateaus.loc[critic_plateaus.index.intersection(year_of_platform_release.index)]
+
+
+# In[ ]:
+
+
+for curve in score_curves:
+    if (curve['score'], curve['dimension']) == ('critic_score', 'platform') and curve['value'] in ['PS4', 'XOne', '3DS']:
+        plt.step(curve['scores'], curve['fit'], where='post', label=curve['value'])
+plt.legend()
+plt.xlabel('critic_score')
+plt.ylabel('sum_sales')
+plt.title('Изотоническая регрессия суммарных продаж от оценки критиков')
+plt.show()
+
+
+# **Вывод**
+# 
+# Теперь для каждой платформы и жанра есть распределение продаж по корзинам оценок и монотонная кривая зависимости продаж от оценки. По колонке `plateau_score` видно, с какой оценки продажи перестают заметно расти, а по разнице `sales_at_max_score` и `sales_at_min_score` — насколько вообще оценки важны в этой группе. Строятся эти кривые по агрегатам, поэтому рисовать миллионы точек на диаграмме рассеяния не нужно.
+
+# <a id='report'></a>
+# # Шаг 15: Генерация отчёта
+
+# Сейчас единственный отчёт — это сам ноутбук с выводами ячеек, и чтобы его обновить нужно перезапустить все ячейки. Соберём статический отчёт в HTML и Markdown из результатов, которые уже лежат в кэше шага 10: топы по регионам, продажи по жанрам (сумма, среднее, медиана), корреляции оценок с продажами, результаты проверки гипотез и заранее отрисованные графики. Каждый раздел отчёта (и его отрисовка в нужный формат) — это тоже операция кэша, поэтому при изменении входных данных пересобираются только те разделы, которые от них зависят, а остальные берутся из кэша.
+
+# In[ ]:
+
+
+import base64
+
+@pipeline.operation
+def regional_tops_section(n=5):
+    return {
+        'Топ-' + str(n) + ' (' + column + ')': pd.DataFrame({
+            region: [label + ' (' + str(round(sales, 2)) + ')' for label, sales in
+                     pipeline.get('actual_top', column=column, region=region, n=n).items()]
+            for region in ['na_sales', 'eu_sales', 'jp_sales']
+        }, index=pd.RangeIndex(1, n + 1, name='место'))
+        for column in ['platform', 'genre', 'rating']
+    }
+
+@pipeline.operation
+def genre_sales_section():
+    genres = pipeline.get('actual_games').pivot_table(
+        index='genre', values='sum_sales', aggfunc=['sum', 'mean', 'median']).droplevel(1, axis=1)
+    return {'Продажи по жанрам': genres.sort_values(by='median', ascending=False)}
+
+@pipeline.operation
+def correlation_section(platforms=('PS4', 'PS3', 'XOne', '3DS')):
+    games = pipeline.get('actual_games')
+    return {'Корреляция оценок с суммарными продажами': pd.DataFrame({
+        score: [games[games['platform'] == platform]['sum_sales'].corr(games[games['platform'] == platform][score])
+                for platform in platforms]
+        for score in ['critic_score', 'user_score']
+    }, index=pd.Index(platforms, name='platform'))}
+
+@pipeline.operation
+def hypotheses_section(alpha=0.05):
+    games = pipeline.get('actual_games')
+    rows = []
+    for column, first, second in [('platform', 'XOne', 'PC'), ('genre', 'Action', 'Sports')]:
+        pvalue = st.ttest_ind(
+            games[games[column] == first]['user_score'], games[games[column] == second]['user_score']).pvalue
+        rows.append({'гипотеза': 'средние user_score ' + first + ' и ' + second + ' равны',
+                     'p-value': pvalue, 'отвергаем H0': pvalue < alpha})
+    return {'Проверка гипотез (alpha = ' + str(alpha) + ')': pd.DataFrame(rows).set_index('гипотеза')}
+
+def figure_png(figure):
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png', bbox_inches='tight')
+    plt.close(figure)
+    return buffer.getvalue()
+
+@pipeline.operation
+def platform_years_figure():
+    year = pipeline.input('last_year')
+    platforms = pipeline.get('platforms_of_year', year=year).index
+    figure, ax = plt.subplots(figsize=(12, 6))
+    pipeline.get('platform_year_sales').loc[year - 10:year, platforms].plot(ax=ax, marker='o')
+    ax.set_title('Суммарные продажи платформ, актуальных на ' + str(year) + ' год')
+    return figure_png(figure)
+
+@pipeline.operation
+def genre_share_figure():
+    figure, ax = plt.subplots(figsize=(8, 8))
+    pipeline.get('actual_games')['genre'].value_counts().plot.pie(ax=ax, autopct='%1.0f%%', startangle=40)
+    ax.set_title('Распределение жанров на данных из актуального периода')
+    return figure_png(figure)
+
+report_sections = [
+    ('Платформы по годам', 'platform_years_figure'),
+    ('Портрет пользователя по регионам', 'regional_tops_section'),
+    ('Жанры', 'genre_share_figure'),
+    ('Жанры и продажи', 'genre_sales_section'),
+    ('Оценки и продажи', 'correlation_section'),
+    ('Гипотезы', 'hypotheses_section'),
+]
+
+def markdown_table(frame):
+    frame = frame.round(3).reset_index()
+    lines = ['| ' + ' | '.join(map(str, frame.columns)) + ' |', '|' + ' --- |' * len(frame.columns)]
+    lines += ['| ' + ' | '.join(map(str, row)) + ' |' for row in frame.itertuples(index=False)]
+    return '\n'.join(lines)
+
+@pipeline.operation
+def rendered_section(section, fmt):
+    result = pipeline.get(section)
+    if isinstance(result, bytes):
+        if fmt == 'html':
+            return '<img src="data:image/png;base64,' + base64.b64encode(result).decode() + '">'
+        return '![' + section + '](figures/' + section + '.png)'
+    if fmt == 'html':
+        return '\n'.join('<h3>' + title + '</h3>\n' + table.round(3).to_html() for title, table in result.items())
+    return '\n\n'.join('### ' + title + '\n\n' + markdown_table(table) for title, table in result.items())
+
+def write_report(folder='./report'):
+    os.makedirs(os.path.join(folder, 'figures'), exist_ok=True)
+    html = ['<html><head><meta charset="utf-8"><title>Определение закономерностей для успешности игры</title>'
+            '</head><body><h1>Определение закономерностей для успешности игры</h1>']
+    markdown = ['# Определение закономерностей для успешности игры']
+    for title, section in report_sections:
+        html.append('<h2>' + title + '</h2>\n' + pipeline.get('rendered_section', section=section, fmt='html'))
+        markdown.append('## ' + title + '\n\n' + pipeline.get('rendered_section', section=section, fmt='md'))
+        result = pipeline.get(section)
+        if isinstance(result, bytes):
+            with open(os.path.join(folder, 'figures', section + '.png'), 'wb') as file:
+                file.write(result)
+    html.append('</body></html>')
+    with open(os.path.join(folder, 'report.html'), 'w', encoding='utf-8') as file:
+        file.write('\n'.join(html))
+    with open(os.path.join(folder, 'report.md'), 'w', encoding='utf-8') as file:
+        file.write('\n\n'.join(markdown) + '\n')
+
+
+# Вернём актуальный период 2012-2016 (в шаге 10 мы меняли его на 2013-2016) и соберём отчёт в папку `report`
+
+# In[ ]:
+
+
+pipeline.set_input('actual_years', range(2012, 2017))
+start = time.perf_counter()
+write_report()
+print('Отчёт собран за', round(time.perf_counter() - start, 2), 'c')
+pipeline.report()
+
+
+# Повторная сборка без изменений берёт все разделы из кэша
+
+# In[ ]:
+
+
+start = time.perf_counter()
+write_report()
+print('Отчёт собран за', round(time.perf_counter() - start, 2), 'c')
+
+
+# Поменяем актуальный период на 2013-2016 и посмотрим какие операции пересчитались при пересборке: график продаж платформ по годам от периода не зависит и остаётся в кэше
+
+# In[ ]:
+
+
+misses = pipeline.report()['misses']
+start = time.perf_counter()
+pipeline.set_input('actual_years', range(2013, 2017))
+write_report()
+print('Отчёт собран за', round(time.perf_counter() - start, 2), 'c')
+pipeline.report()['misses'] - misses
+
+
+# Теперь обновим данные на очищенную выгрузку из шага 13 и вернём актуальный период 2012-2016. От данных зависят все разделы, но отчёт всё равно собирается за секунды
+
+# In[ ]:
+
+
+start = time.perf_counter()
+pipeline.set_input('actual_years', range(2012, 2017))
+pipeline.set_input('games', refreshed['cleaned'])
+write_report()
+print('Отчёт собран за', round(time.perf_counter() - start, 2), 'c')
+pipeline.report()
+
+
+# Вернём исходный `df` и пересоберём отчёт, чтобы он соответствовал данным ноутбука
+
+# In[ ]:
+
+
+pipeline.set_input('games', df)
+write_report()
+
+
+# **Вывод**
+# 
+# Отчёт `report/report.html` (с графиками внутри файла) и `report/report.md` (графики лежат в `report/figures`) собирается из кэша пайплайна. Пересобираются только разделы, входные данные которых поменялись, поэтому обновление отчёта после небольшого изменения данных занимает секунды, а не перезапуск всего ноутбука.
+
+# <a id='robust_stats'></a>
+# # Шаг 16: Статистики с учётом заполненных пропусков
+
+# Большая доля `critic_score` и `user_score` заполнена медианами по категориям продаж, и эти значения напрямую попадают в средние, стандартные отклонения, корреляции и t-тесты по `actual_df`. Заполненные значения одинаковы внутри категории, поэтому они занижают разброс и тянут средние к медианам категорий. Посчитаем для каждой группы сразу несколько вариантов статистик по маскам заполнения из шага 7:
+# 
+# - `all` — обычные статистики по всем значениям, как в шаге 5;
+# - `observed` — только по реально выставленным оценкам;
+# - `weighted` — по выставленным оценкам с весом обратным доле выставленных оценок в категории продаж (оценки чаще есть у хорошо продающихся игр, веса это выравнивают);
+# - робастные: усечённое среднее (отбрасываем по 10% с каждой стороны) и MAD (медиана абсолютных отклонений от медианы).
+# 
+# Все статистики считаются без цикла по группам: значения один раз сортируются внутри групп (`np.lexsort`), после чего суммы, медианы и усечённые средние берутся по границам групп из накопленных сумм, а взвешенные суммы — через `np.bincount`.
+
+# In[ ]:
+
+
+def sorted_group_stats(codes, values, groups, trim):
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+    counts = np.bincount(codes, minlength=groups)
+    if not len(values):
+        return dict(n=counts, **{stat: np.full(groups, np.nan) for stat in ['mean', 'std', 'median', 'trimmed_mean', 'mad']})
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    cumulative = np.concatenate([[0], np.cumsum(values)])
+    squares = np.bincount(codes, weights=values ** 2, minlength=groups)
+    cut = np.floor(trim * counts).astype(int)
+    lower, upper = starts + (counts - 1) // 2, starts + counts // 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (cumulative[ends] - cumulative[starts]) / counts
+        median = np.where(counts > 0, (values.take(lower, mode='clip') + values.take(upper, mode='clip')) / 2, np.nan)
+        deviations = np.abs(values - np.repeat(median, counts))
+        deviations = deviations[np.lexsort((deviations, codes))]
+        return {
+            'n': counts,
+            'mean': mean,
+            'std': np.sqrt(np.maximum(squares / counts - mean ** 2, 0)),
+            'median': median,
+            'trimmed_mean': (cumulative[ends - cut] - cumulative[starts + cut]) / (counts - 2 * cut),
+            'mad': np.where(
+                counts > 0, (deviations.take(lower, mode='clip') + deviations.take(upper, mode='clip')) / 2, np.nan),
+        }
+
+def group_statistics(data, by, value, imputed, strata='type_by_sum_sales', trim=0.1):
+    codes, labels = pd.factorize(data[by], sort=True)
+    values = data[value].to_numpy(dtype='float64')
+    observed = ~np.asarray(imputed)
+    observed_share = pd.Series(observed).groupby(np.asarray(data[strata])).transform('mean').to_numpy()
+    weights = np.divide(1, observed_share, out=np.zeros(len(values)), where=observed)
+    weight_sums = np.bincount(codes, weights=weights, minlength=len(labels))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weighted_mean = np.bincount(codes, weights=weights * values, minlength=len(labels)) / weight_sums
+        weighted_std = np.sqrt(np.maximum(
+            np.bincount(codes, weights=weights * values ** 2, minlength=len(labels)) / weight_sums
+            - weighted_mean ** 2, 0))
+    return pd.concat({
+        'all': pd.DataFrame(sorted_group_stats(codes, values, len(labels), trim), index=labels),
+        'observed': pd.DataFrame(
+            sorted_group_stats(codes[observed], values[observed], len(labels), trim), index=labels),
+        'weighted': pd.DataFrame({'mean': weighted_mean, 'std': weighted_std}, index=labels),
+    }, axis=1).rename_axis(by)
+
+imputed_scores = pd.DataFrame(
+    {score: unpack_na_mask(na_bitmaps, score, len(df)) for score in ['critic_score', 'user_score']}, index=df.index)
+
+
+# Статистики `user_score` по платформам за актуальный период. Проверим что обычные среднее и стандартное отклонение совпадают с посчитанными в шаге 5, а если все оценки заполнены, то статистики по реально выставленным оценкам пустые
+
+# In[ ]:
+
+
+platform_user_stats = group_statistics(
+    actual_df, 'platform', 'user_score', imputed_scores.loc[actual_df.index, 'user_score'])
+for platform in ['XOne', 'PC']:
+    assert np.isclose(platform_user_stats.loc[platform, ('all', 'mean')],
+                      np.mean(actual_df[actual_df['platform'] == platform]['user_score']))
+    assert np.isclose(platform_user_stats.loc[platform, ('all', 'std')],
+                      np.std(actual_df[actual_df['platform'] == platform]['user_score']))
+all_imputed = group_statistics(actual_df, 'platform', 'user_score', np.ones(len(actual_df), dtype=bool))
+assert (all_imputed[('observed', 'n')] == 0).all() and all_imputed['observed'].drop(columns='n').isna().all().all()
+platform_user_stats
+
+
+# In[ ]:
+
+
+genre_user_stats = group_statistics(
+    actual_df, 'genre', 'user_score', imputed_scores.loc[actual_df.index, 'user_score'])
+genre_user_stats
+
+
+# Насколько заполнение пропусков сдвигает среднюю оценку критиков по платформам
+
+# In[ ]:
+
+
+platform_critic_stats = group_statistics(
+    actual_df, 'platform', 'critic_score', imputed_scores.loc[actual_df.index, 'critic_score'])
+pd.DataFrame({
+    'доля заполненных': 1 - platform_critic_stats[('observed', 'n')] / platform_critic_stats[('all', 'n')],
+    'all - observed': platform_critic_stats[('all', 'mean')] - platform_critic_stats[('observed', 'mean')],
+    'all - weighted': platform_critic_stats[('all', 'mean')] - platform_critic_stats[('weighted', 'mean')],
+})
+
+
+# Повторим проверку гипотез из шага 5 на реально выставленных оценках: обычный t-тест и t-тест Юэна по усечённым средним (`trim=0.1`), который устойчив к выбросам и тяжёлым хвостам
+
+# In[ ]:
+
+
+observed_user_score = actual_df['user_score'].where(~imputed_scores.loc[actual_df.index, 'user_score'])
+hypotheses_variants = []
+for column, first, second in [('platform', 'XOne', 'PC'), ('genre', 'Action', 'Sports')]:
+    samples = {name: [scores[actual_df[column] == first].dropna(), scores[actual_df[column] == second].dropna()]
+               for name, scores in [('all', actual_df['user_score']), ('observed', observed_user_score)]}
+    hypotheses_variants.append({
+        'гипотеза': first + ' = ' + second,
+        'all': st.ttest_ind(*samples['all']).pvalue,
+        'observed': st.ttest_ind(*samples['observed']).pvalue,
+        'observed_trimmed': st.ttest_ind(*samples['observed'], trim=0.1).pvalue,
+    })
+pd.DataFrame(hypotheses_variants).set_index('гипотеза')
+
+
+# Корреляции оценок с суммарными продажами по актуальным платформам: по всем значениям и только по выставленным оценкам (Пирсон и ранговая корреляция Спирмена)
+
+# In[ ]:
+
+
+score_correlations = {}
+for platform in year_of_platform_release.index:
+    games = actual_df[actual_df['platform'] == platform]
+    for score in ['critic_score', 'user_score']:
+        observed = games[~imputed_scores.loc[games.index, score]]
+        score_correlations[(platform, score)] = {
+            'all': games['sum_sales'].corr(games[score]),
+            'observed': observed['sum_sales'].corr(observed[score]),
+            'observed_spearman': observed['sum_sales'].corr(observed[score], method='spearman'),
+        }
+pd.DataFrame(score_correlations).T
+
+
+# **Вывод**
+# 
+# Теперь для каждой группы одним вызовом получаются обычные статистики, статистики только по выставленным оценкам, взвешенные с поправкой на то, что оценки чаще есть у хорошо продающихся игр, и робастные (усечённое среднее и MAD). Видно, что заполненные медианами оценки занижают стандартное отклонение, а значит и p-value t-тестов, поэтому выводы шага 5 стоит проверять и на реально выставленных оценках.
+
+# <a id='affinity'></a>
+# # Шаг 17: Сочетания жанров и платформ
+
+# Сводная таблица `actual_df.pivot_table(index='genre', values='sum_sales', aggfunc=['sum','mean','median'])` смотрит только на жанр, а топы шага 4 — только на платформу, но не на их сочетание. Построим матрицу жанр × платформа для каждого региона: продажи, число игр с продажами в регионе и lift — во сколько раз доля сочетания в продажах региона больше ожидаемой при независимости жанра и платформы (`lift = продажи(жанр, платформа) * продажи региона / (продажи(жанр) * продажи(платформа))`). Большинство сочетаний из длинного хвоста пустые или почти пустые, поэтому матрицы храним разреженными (`scipy.sparse`), заполнены только реально встречающиеся сочетания. Матрицы считаются операцией кэша из шага 10 по срезу актуального периода, т.е один раз на загрузку данных, а запросы вида «лучший жанр для XOne в Европе» — это срез столбца разреженной матрицы.
+
+# In[ ]:
+
+
+from scipy import sparse
+
+@pipeline.operation
+def genre_platform_affinity(regions=('na_sales', 'eu_sales', 'jp_sales', 'other_sales')):
+    games = pipeline.get('actual_games')
+    genre_codes, genres = pd.factorize(games['genre'], sort=True)
+    platform_codes, platforms = pd.factorize(games['platform'], sort=True)
+    cells, cell_codes = np.unique(genre_codes * len(platforms) + platform_codes, return_inverse=True)
+    rows, columns = np.divmod(cells, len(platforms))
+    shape = (len(genres), len(platforms))
+    affinity = {'genres': np.asarray(genres), 'platforms': np.asarray(platforms)}
+    for region in regions:
+        sales = games[region].to_numpy()
+        cell_sales = np.bincount(cell_codes, weights=sales, minlength=len(cells))
+        cell_counts = np.bincount(cell_codes[sales > 0], minlength=len(cells))
+        genre_sales = np.bincount(rows, weights=cell_sales, minlength=len(genres))
+        platform_sales = np.bincount(columns, weights=cell_sales, minlength=len(platforms))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lift = cell_sales * cell_sales.sum() / (genre_sales[rows] * platform_sales[columns])
+        present = cell_counts > 0
+        affinity[region] = {
+            name: sparse.csr_matrix((values[present], (rows[present], columns[present])), shape=shape)
+            for name, values in [('sales', cell_sales), ('count', cell_counts), ('lift', lift)]
+        }
+    return affinity
+
+def affinity_top(affinity, region, k=3, genre=None, platform=None, by='sales', min_count=5):
+    if (genre is None) == (platform is None):
+        raise ValueError('Нужно задать ровно одно из genre и platform')
+    if platform is not None:
+        axis, labels, found = 0, affinity['genres'], np.flatnonzero(affinity['platforms'] == platform)
+    else:
+        axis, labels, found = 1, affinity['platforms'], np.flatnonzero(affinity['genres'] == genre)
+    matrices = affinity[region]
+    vectors = {
+        name: (matrix.getcol(found[0]) if axis == 0 else matrix.getrow(found[0])).toarray().ravel()
+        if len(found) else np.zeros(len(labels), dtype=matrix.dtype)
+        for name, matrix in matrices.items()
+    }
+    candidates = np.flatnonzero((vectors['count'] >= min_count) & (vectors['count'] > 0))
+    best = candidates[np.argsort(-vectors[by][candidates], kind='stable')[:k]]
+    return pd.DataFrame({name: vector[best] for name, vector in vectors.items()},
+                        index=pd.Index(labels[best], name='genre' if axis == 0 else 'platform'))
+
+
+# In[ ]:
+
+
+affinity = pipeline.get('genre_platform_affinity')
+filled = affinity['na_sales']['count'].nnz
+print('Заполнено сочетаний:', filled, 'из', len(affinity['genres']) * len(affinity['platforms']))
+
+
+# Проверим что суммы в матрице совпадают с группировкой по жанру и платформе
+
+# In[ ]:
+
+
+for region in ['na_sales', 'eu_sales', 'jp_sales']:
+    expected = actual_df.groupby(['genre', 'platform'])[region].sum()
+    expected = expected[expected > 0]
+    matrix = affinity[region]['sales'].tocoo()
+    actual = pd.Series(matrix.data, index=pd.MultiIndex.from_arrays(
+        [affinity['genres'][matrix.row], affinity['platforms'][matrix.col]], names=['genre', 'platform']))
+    assert np.allclose(actual[actual > 0].sort_index(), expected.sort_index())
+
+
+# Лучшие жанры для XOne в Европе по продажам и по lift
+
+# In[ ]:
+
+
+affinity_top(affinity, 'eu_sales', platform='XOne')
+
+
+# In[ ]:
+
+
+affinity_top(affinity, 'eu_sales', platform='XOne', by='lift')
+
+
+# Лучшие платформы для жанра Role-Playing в Японии и в Северной Америке
+
+# In[ ]:
+
+
+pd.concat({
+    region: affinity_top(affinity, region, genre='Role-Playing', by='lift') for region in ['jp_sales', 'na_sales']
+})
+
+
+# Для каждой актуальной платформы лучший по lift жанр в каждом регионе. Если у платформы в регионе нет ни одного жанра хотя бы с 5 играми, `affinity_top` возвращает пустую таблицу, и в ячейке остаётся пропуск. Так же пустая таблица возвращается для платформы или жанра, которых нет в актуальном периоде (например NES).
+
+# In[ ]:
+
+
+def best_by_lift(region, platform):
+    top = affinity_top(affinity, region, k=1, platform=platform, by='lift')
+    return top.index[0] if len(top) else None
+
+assert affinity_top(affinity, 'jp_sales', platform='PC', min_count=len(df) + 1).empty
+assert affinity_top(affinity, 'jp_sales', platform='NES').empty
+pd.DataFrame({
+    region: [best_by_lift(region, platform) for platform in year_of_platform_release.index]
+    for region in ['na_sales', 'eu_sales', 'jp_sales']
+}, index=year_of_platform_release.index)
+
+
+# **Вывод**
+# 
+# Матрицы жанр × платформа × регион строятся один раз на загрузку данных и хранят только реально встречающиеся сочетания. Запрос лучших жанров для платформы или лучших платформ для жанра в регионе — это срез одного столбца или строки разреженной матрицы. Lift показывает сочетания, которые продаются лучше, чем можно было бы ожидать по отдельной популярности жанра и платформы. Сочетания, где меньше 5 игр, из запросов отбрасываем, чтобы единичные хиты не попадали в топ.
+
+# <a id='columnar'></a>
+# # Шаг 18: Общий файл данных для параллельных процессов
+
+# Когда несколько анализов запускаются параллельно (разные периоды, регионы, гипотезы), каждый процесс заново читает `games.csv` и держит в памяти свой очищенный `df`. Запишем очищенные колонки один раз в колоночный файл: небольшой json-заголовок (число строк, тип, смещение и категории каждой колонки), а за ним данные колонок подряд, выровненные по 64 байта. Берём компактный каталог из шага 7, т.е строки уже закодированы категориями (в файл пишутся коды, а словарь значений лежит в заголовке), продажи во float32, год в int16, плюс маски заполненных оценок. Процесс открывает файл через `np.memmap` только на чтение и получает колонки как представления NumPy без копирования. Данные читаются из общего кэша страниц ОС, поэтому N процессов делят одну копию данных, а открытие файла занимает миллисекунды.
+
+# In[ ]:
+
+
+import json
+import subprocess
+
+columnar_path = './games_columnar.bin'
+columnar_alignment = 64
+
+def aligned(offset):
+    return offset + (-offset) % columnar_alignment
+
+def write_columnar(frame, path):
+    columns, arrays, offset = {}, [], 0
+    for name, column in frame.items():
+        categories = None
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            categories = column.cat.categories.tolist()
+            column = column.cat.codes
+        values = np.ascontiguousarray(column.to_numpy())
+        offset = aligned(offset)
+        columns[name] = {'dtype': values.dtype.str, 'offset': offset, 'categories': categories}
+        arrays.append((offset, values))
+        offset += values.nbytes
+    header = json.dumps({'rows': len(frame), 'columns': columns}, ensure_ascii=False).encode('utf-8')
+    base = aligned(8 + len(header))
+    with open(path, 'wb') as file:
+        file.write(len(header).to_bytes(8, 'little'))
+        file.write(header)
+        for offset, values in arrays:
+            file.seek(base + offset)
+            file.write(values.tobytes())
+
+def open_columnar(path):
+    with open(path, 'rb') as file:
+        header = json.loads(file.read(int.from_bytes(file.read(8), 'little')))
+    buffer = np.memmap(path, dtype='uint8', mode='r')
+    base = aligned(8 + int.from_bytes(buffer[:8].tobytes(), 'little'))
+    columns = {}
+    for name, column in header['columns'].items():
+        dtype = np.dtype(column['dtype'])
+        start = base + column['offset']
+        columns[name] = buffer[start:start + header['rows'] * dtype.itemsize].view(dtype)
+    return header, columns
+
+def columnar_frame(header, columns):
+    return pd.DataFrame({
+        name: pd.Categorical.from_codes(columns[name], header['columns'][name]['categories'])
+        if header['columns'][name]['categories'] is not None else columns[name]
+        for name in columns
+    })
+
+
+# In[ ]:
+
+
+start = time.perf_counter()
+write_columnar(catalogue.assign(
+    critic_score_imputed=imputed_scores['critic_score'].to_numpy(),
+    user_score_imputed=imputed_scores['user_score'].to_numpy(),
+), columnar_path)
+print('Файл записан за', round(time.perf_counter() - start, 3), 'c, размер',
+      round(os.path.getsize(columnar_path) / 2**20, 2), 'MB')
+
+
+# Проверим что колонки открываются без копирования (это представления поверх `np.memmap`) и что собранная из них таблица совпадает с каталогом
+
+# In[ ]:
+
+
+columnar_header, columnar_columns = open_columnar(columnar_path)
+assert all(isinstance(values.base, np.memmap) and not values.flags.writeable for values in columnar_columns.values())
+pd.testing.assert_frame_equal(
+    columnar_frame(columnar_header, columnar_columns).drop(columns=['critic_score_imputed', 'user_score_imputed']),
+    catalogue.reset_index(drop=True))
+
+
+# Запустим параллельные процессы, каждый из которых сам открывает файл и считает топ-5 по региону для своих периодов. Процессу передаётся только путь к файлу и список задач, а не данные. Топы считаются прямо по кодам категорий через `np.bincount`.
+# 
+# Процессы запускаются как новые интерпретаторы Python через `subprocess`, а не через `fork`, т.е ничего не наследуют от ноутбука: код функций передаётся им текстом, а данные они получают только из файла. Так проверяется, что `open_columnar` работает в любом процессе, и это одинаково работает на Linux, macOS и Windows.
+
+# In[ ]:
+
+
+def columnar_top(task):
+    path, first_year, column, region = task
+    start = time.perf_counter()
+    header, columns = open_columnar(path)
+    open_time = time.perf_counter() - start
+    period = (columns['year_of_release'] >= first_year) & (columns['year_of_release'] <= 2016)
+    codes, sales = columns[column][period], columns[region][period]
+    categories = header['columns'][column]['categories']
+    totals = np.bincount(codes[codes >= 0], weights=sales[codes >= 0], minlength=len(categories))
+    best = np.argsort(-totals, kind='stable')[:5]
+    return {'first_year': first_year, 'column': column, 'region': region, 'open_ms': open_time * 1000,
+            'top': pd.Series(totals[best], index=[categories[code] for code in best])}
+
+columnar_worker_source = '\n'.join(
+    ['import json', 'import sys', 'import time', 'import numpy as np', 'import pandas as pd',
+     'columnar_alignment = ' + repr(columnar_alignment)]
+    + [inspect.getsource(func) for func in [aligned, open_columnar, columnar_top]]
+    + ["print(json.dumps([dict(top, top=list(top['top'].items())) for top in map(columnar_top, json.loads(sys.argv[1]))]))"])
+
+def run_columnar_workers(tasks, processes):
+    running = [
+        subprocess.Popen([sys.executable, '-c', columnar_worker_source, json.dumps(tasks[part::processes])],
+                         stdout=subprocess.PIPE, text=True)
+        for part in range(min(processes, len(tasks)))
+    ]
+    results = []
+    for process in running:
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError('Процесс завершился с кодом ' + str(process.returncode))
+        results += [dict(top, top=pd.Series(dict(top['top']), dtype='float64')) for top in json.loads(output)]
+    return results
+
+columnar_tasks = list(product(
+    [columnar_path], range(2005, 2015), ['platform', 'genre'], ['na_sales', 'eu_sales', 'jp_sales']))
+start = time.perf_counter()
+columnar_tops = run_columnar_workers(columnar_tasks, workers)
+print(len(columnar_tops), 'задач за', round(time.perf_counter() - start, 2), 'c, медианное время открытия файла',
+      round(np.median([top['open_ms'] for top in columnar_tops]), 2), 'мс')
+
+
+# Сверим результат процессов с группировкой по `df`: и суммы, и порядок лидеров
+
+# In[ ]:
+
+
+for top in columnar_tops:
+    expected = df[df['year_of_release'].between(top['first_year'], 2016)].groupby(
+        top['column'])[top['region']].sum().sort_values(ascending=False).head()
+    assert np.allclose(top['top'], expected, rtol=1e-4)
+    assert list(top['top'].index) == list(expected.index)
+pd.DataFrame([
+    {'first_year': top['first_year'], 'region': top['region'], 'top': ', '.join(top['top'].index)}
+    for top in columnar_tops if top['column'] == 'platform'
+]).pivot(index='first_year', columns='region', values='top')
+
+
+# **Вывод**
+# 
+# Очищенные данные записываются в один колоночный файл один раз, а каждый процесс открывает его за миллисекунды и работает с колонками как с обычными массивами NumPy без копирования. Память под данные общая для всех процессов (кэш страниц ОС), поэтому параллельные анализы больше не читают `games.csv` и не держат каждый свою копию `df`. Процессы в примере запускаются отдельными интерпретаторами, а не через `fork`, поэтому тот же `open_columnar` работает из любого скрипта или процесса на любой ОС.